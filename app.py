@@ -1,11 +1,13 @@
 import streamlit as st
 import polars as pl
-from io import BytesIO
+import os
+import tempfile
 import time
 import hashlib
+import xxhash
 from modules.data_loader import load_excel_data
 from modules.ui_components import render_operation_ui, OPERATION_OPTIONS
-from modules.formula_translator import apply_analysis
+from modules.formula_translator import apply_analysis_lazy, build_expr, EXPRESSION_OPS
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -14,6 +16,16 @@ st.set_page_config(
     layout="wide"
 )
 
+# Only this many rows are sent to the browser unless the user asks for the full table
+PREVIEW_ROW_LIMIT = 1000
+
+def display_dataframe(df, key):
+    """Shows the first PREVIEW_ROW_LIMIT rows of df, with a checkbox to show every row."""
+    show_all = False
+    if df.height > PREVIEW_ROW_LIMIT:
+        show_all = st.checkbox(f"Show all {df.height:,} rows (may be slow)", key=key)
+    st.dataframe(df if show_all else df.head(PREVIEW_ROW_LIMIT), use_container_width=True, height=300)
+
 # --- Initialize Session State ---
 if 'dataframes' not in st.session_state:
     st.session_state.dataframes = None
@@ -25,6 +37,12 @@ if 'analysis_definitions' not in st.session_state:
     st.session_state.analysis_definitions = []
 if 'active_file_hash' not in st.session_state:
     st.session_state.active_file_hash = None
+if 'lookup_cache' not in st.session_state:
+    st.session_state.lookup_cache = {}
+if 'main_df_meta_key' not in st.session_state:
+    st.session_state.main_df_meta_key = None
+    st.session_state.main_df_columns = []
+    st.session_state.main_df_shape = (0, 0)
 
 # --- Sidebar for Controls ---
 with st.sidebar:
@@ -38,19 +56,28 @@ with st.sidebar:
     )
 
     if uploaded_file is not None:
-        file_bytes = uploaded_file.getvalue()
-        file_hash = hashlib.md5(file_bytes).hexdigest()
+        # Hash the upload through a zero-copy view of its buffer; the bytes are only
+        # copied out below when a new file actually has to be loaded.
+        # The fast XXH3 hash only detects a new upload within this session.
+        with uploaded_file.getbuffer() as file_view:
+            file_hash = xxhash.xxh3_64_hexdigest(file_view)
 
         if st.session_state.active_file_hash != file_hash:
+            # The loader's caches are shared across sessions and persisted to disk, so they are
+            # keyed by a collision-resistant digest that a crafted upload cannot forge
+            with uploaded_file.getbuffer() as file_view:
+                content_digest = hashlib.blake2b(file_view, digest_size=32).hexdigest()
+
             # This logic is based on the user's trusted version.
-            # The data loader now uses the @st.cache_data decorator.
-            loaded_dfs = load_excel_data(file_bytes, uploaded_file.name)
+            # The data loader now uses the @st.cache_resource decorator.
+            loaded_dfs = load_excel_data(uploaded_file.getvalue(), uploaded_file.name, content_digest)
 
             # Update state for the new file
             st.session_state.active_file_hash = file_hash
             st.session_state.dataframes = loaded_dfs
             st.session_state.analysis_definitions = []
             st.session_state.preview_df = None
+            st.session_state.lookup_cache = {}
             
             # CRITICAL FIX: Explicitly check the type and content of loaded_dfs
             if isinstance(loaded_dfs, dict) and loaded_dfs:
@@ -73,17 +100,18 @@ with st.sidebar:
                 st.session_state.main_df_name = None
                 current_index = 0
 
+        def change_main_sheet():
+            st.session_state.main_df_name = st.session_state.main_df_selector
+            st.session_state.preview_df = None
+
         if st.session_state.main_df_name:
-            selected_df_name = st.selectbox(
+            st.selectbox(
                 "Select main worksheet for analysis",
                 options=df_names,
                 index=current_index,
-                key="main_df_selector"
+                key="main_df_selector",
+                on_change=change_main_sheet
             )
-            if st.session_state.main_df_name != selected_df_name:
-                st.session_state.main_df_name = selected_df_name
-                st.session_state.preview_df = None
-                st.rerun()
 
 # --- Main Application Area ---
 st.title("⚡ High-Performance Excel Analyzer")
@@ -91,11 +119,18 @@ st.title("⚡ High-Performance Excel Analyzer")
 # CRITICAL FIX: This main condition uses explicit checks to prevent the "truth value" error.
 if st.session_state.main_df_name and isinstance(st.session_state.dataframes, dict) and st.session_state.dataframes:
     main_df = st.session_state.dataframes[st.session_state.main_df_name]
+
+    # Column names and shape only change with the file or the selected sheet
+    main_df_meta_key = (st.session_state.active_file_hash, st.session_state.main_df_name)
+    if st.session_state.main_df_meta_key != main_df_meta_key:
+        st.session_state.main_df_columns = main_df.columns
+        st.session_state.main_df_shape = main_df.shape
+        st.session_state.main_df_meta_key = main_df_meta_key
     
     st.header(f"Original Data: `{st.session_state.main_df_name}`")
-    st.dataframe(main_df, use_container_width=True, height=300)
+    display_dataframe(main_df, key="show_all_main_rows")
     
-    n_rows, n_cols = main_df.shape
+    n_rows, n_cols = st.session_state.main_df_shape
     st.write(f"Shape: **{n_rows:,}** rows, **{n_cols}** columns")
 
     st.header("Analysis Builder")
@@ -106,8 +141,23 @@ if st.session_state.main_df_name and isinstance(st.session_state.dataframes, dic
 
     st.button("➕ Add New Analysis Step", on_click=add_analysis_step)
 
+    operation_keys = list(OPERATION_OPTIONS.keys())
+    operation_values = list(OPERATION_OPTIONS.values())
+
+    def change_operation_type(i, key_prefix):
+        # Switching the operation type resets the step's parameters, keeping only its name
+        new_op_key = operation_keys[operation_values.index(st.session_state[f"{key_prefix}_op_type"])]
+        new_col_name = st.session_state.get(f"{key_prefix}_new_col_name", '')
+        st.session_state.analysis_definitions[i] = {
+            'new_col_name': new_col_name,
+            'operation_type': new_op_key
+        }
+
     # --- Analysis Pipeline Definition ---
-    for i, analysis_def in enumerate(st.session_state.analysis_definitions):
+    # Each step is its own fragment, so a widget change only reruns the step it belongs to
+    @st.fragment
+    def render_step(i, main_df_columns):
+        analysis_def = st.session_state.analysis_definitions[i]
         key_prefix = f"analysis_{i}"
         expander_title = f"Step {i+1}: {analysis_def.get('new_col_name') or 'New Step'}"
         
@@ -121,59 +171,122 @@ if st.session_state.main_df_name and isinstance(st.session_state.dataframes, dic
                 )
             with col2:
                 if st.button("❌ Remove Step", key=f"{key_prefix}_remove"):
+                    # Removing a step renumbers the ones after it, so rerun the whole app
                     st.session_state.analysis_definitions.pop(i)
                     st.rerun()
 
-            operation_keys = list(OPERATION_OPTIONS.keys())
-            operation_values = list(OPERATION_OPTIONS.values())
             current_op_key = analysis_def.get('operation_type')
             current_op_index = operation_keys.index(current_op_key) if current_op_key in operation_keys else 0
 
-            selected_op_value = st.selectbox(
+            st.selectbox(
                 "Select Operation Type",
                 options=operation_values,
                 index=current_op_index,
-                key=f"{key_prefix}_op_type"
+                key=f"{key_prefix}_op_type",
+                on_change=change_operation_type,
+                args=(i, key_prefix)
             )
-            new_op_key = operation_keys[operation_values.index(selected_op_value)]
-
-            st.session_state.analysis_definitions[i]['new_col_name'] = new_col_name
-            if new_op_key != current_op_key:
-                st.session_state.analysis_definitions[i] = {
-                    'new_col_name': new_col_name,
-                    'operation_type': new_op_key
-                }
-                st.rerun()
+
+            analysis_def['new_col_name'] = new_col_name
             
             render_operation_ui(
-                st.session_state.analysis_definitions[i],
+                analysis_def,
                 st.session_state.dataframes,
-                main_df.columns,
+                main_df_columns,
                 key_prefix
             )
             st.markdown("---")
 
+    for i in range(len(st.session_state.analysis_definitions)):
+        render_step(i, st.session_state.main_df_columns)
+
 
     # --- Pipeline Execution ---
+    def build_pipeline(base_lf, execute_each_step=False):
+        """
+        Chains every analysis step onto base_lf as one lazy query.
+        The schema is resolved after each step so that errors point at the step that caused them.
+        With execute_each_step, each step is also run (used on an empty frame to locate
+        errors that only show up at execution time).
+        Returns (lazy_frame, None), or (None, (step_index, step_def, error)) for the first failing step.
+        """
+        temp_lf = base_lf
+        # Consecutive MATH/IF steps are collected here and added in one with_columns call
+        batch_exprs = []
+        batch_outputs = set()
+
+        def check_step(step_lf):
+            if execute_each_step:
+                step_lf.collect()
+            else:
+                step_lf.collect_schema()
+
+        for i, step_def in enumerate(st.session_state.analysis_definitions):
+            try:
+                if step_def.get('operation_type') in EXPRESSION_OPS and step_def.get('new_col_name'):
+                    # Batch outputs are never Categorical, so the schema before the batch is enough
+                    expr = build_expr(step_def, temp_lf.collect_schema())
+                    # A step that reads or overwrites a column from the current batch starts a new batch
+                    if batch_outputs & (set(expr.meta.root_names()) | {expr.meta.output_name()}):
+                        temp_lf = temp_lf.with_columns(batch_exprs)
+                        batch_exprs, batch_outputs = [], set()
+                    # The expression only reads columns outside the batch, so it can be checked on its own
+                    check_step(temp_lf.with_columns(expr))
+                    batch_exprs.append(expr)
+                    batch_outputs.add(expr.meta.output_name())
+                    continue
+
+                if batch_exprs:
+                    temp_lf = temp_lf.with_columns(batch_exprs)
+                    batch_exprs, batch_outputs = [], set()
+                temp_lf = apply_analysis_lazy(temp_lf, step_def, st.session_state.dataframes)
+                check_step(temp_lf)
+            except Exception as e:
+                return None, (i, step_def, e)
+
+        if batch_exprs:
+            temp_lf = temp_lf.with_columns(batch_exprs)
+        return temp_lf, None
+
+    def report_step_error(failure):
+        i, step_def, e = failure
+        st.error(f"**Error in Step {i+1} ('{step_def.get('new_col_name', 'N/A')}')**: {e}")
+
     if st.session_state.analysis_definitions:
         if st.button("🚀 Generate Preview / Apply All Steps", type="primary"):
             with st.spinner("Applying analysis pipeline... Please wait."):
                 start_time = time.time()
-                temp_df = main_df.clone()
-                error_occured = False
-                
-                for i, step_def in enumerate(st.session_state.analysis_definitions):
+                # Build the whole pipeline as one lazy query so Polars can optimize it end to end
+                temp_lf, failure = build_pipeline(main_df.lazy())
+                error_occured = failure is not None
+                if failure:
+                    report_step_error(failure)
+
+                if not error_occured:
                     try:
-                        temp_df = apply_analysis(temp_df, step_def, st.session_state.dataframes)
+                        temp_df = temp_lf.collect(engine='streaming')
                     except Exception as e:
-                        st.error(f"**Error in Step {i+1} ('{step_def.get('new_col_name', 'N/A')}')**: {e}")
                         error_occured = True
-                        break
+                        # Replay the steps on an empty copy of the sheet to find the step that fails
+                        _, failure = build_pipeline(main_df.clear().lazy(), execute_each_step=True)
+                        if failure:
+                            report_step_error(failure)
+                        else:
+                            st.error(f"**Error while executing the pipeline**: {e}")
                 
                 end_time = time.time()
                 duration = end_time - start_time
 
                 if not error_occured:
+                    # Targeted output is clamped inside the plan, so a start row past the end of
+                    # the table writes nothing; tell the user which step was affected
+                    for i, step_def in enumerate(st.session_state.analysis_definitions):
+                        start_row = step_def.get('output_start_row')
+                        if step_def.get('operation_type') == 'CONDITIONAL_AGG' and start_row and start_row > temp_df.height:
+                            st.error(
+                                f"**Step {i+1} ('{step_def.get('new_col_name', 'N/A')}')**: Start row {start_row} "
+                                f"is beyond the end of the table ({temp_df.height} rows)."
+                            )
                     st.session_state.preview_df = temp_df
                     st.success(f"✅ Analysis pipeline completed successfully in {duration:.2f} seconds.")
 
@@ -182,21 +295,25 @@ if st.session_state.main_df_name and isinstance(st.session_state.dataframes, dic
         st.header("📊 Preview of Analyzed Data")
         st.info("This is a preview of your data after applying all steps. Your original data remains unchanged.")
         preview_df = st.session_state.preview_df
-        st.dataframe(preview_df, use_container_width=True, height=300)
+        display_dataframe(preview_df, key="show_all_preview_rows")
         
         prev_n_rows, prev_n_cols = preview_df.shape
         st.write(f"Preview Shape: **{prev_n_rows:,}** rows, **{prev_n_cols}** columns")
 
         st.header("Export Results")
-        with BytesIO() as buf:
-            preview_df.write_csv(buf)
-            csv_data = buf.getvalue()
-
-        st.download_button(
-            label="Download Analyzed Data as CSV",
-            data=csv_data,
-            file_name=f"{st.session_state.main_df_name}_analyzed.csv",
-            mime="text/csv",
-        )
+        # Stream the CSV to a temp file instead of building it in an in-memory buffer
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as tmp:
+            csv_path = tmp.name
+        try:
+            preview_df.lazy().sink_csv(csv_path, engine='streaming')
+            with open(csv_path, 'rb') as csv_file:
+                st.download_button(
+                    label="Download Analyzed Data as CSV",
+                    data=csv_file,
+                    file_name=f"{st.session_state.main_df_name}_analyzed.csv",
+                    mime="text/csv",
+                )
+        finally:
+            os.remove(csv_path)
 else:
     st.info("👋 Welcome! Please upload an Excel file using the sidebar to begin.")
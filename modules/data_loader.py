@@ -1,36 +1,204 @@
 import streamlit as st
 import polars as pl
 import pandas as pd
+import pyarrow as pa
+import fastexcel
+import os
+import shutil
+import tempfile
+import time
+import uuid
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-# This is the user-provided "last working" version of the data loader.
-# It uses the pandas engine, which was working for most files.
-# The @st.cache_data decorator is used here as it was in the original trusted version.
-@st.cache_data(show_spinner="Loading and caching Excel file...")
-def load_excel_data(file_content, file_name):
+# String columns with fewer distinct values than this fraction of rows are stored as Categorical
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.05
+
+def _categorize_low_cardinality(df):
+    """
+    Casts low-cardinality text columns (e.g. "Region", "Product") to pl.Categorical,
+    so equality filters compare integer codes instead of strings.
+    Columns holding numbers stored as text are left as strings so math steps can still parse them.
+    """
+    categorical_cols = [
+        col for col, dtype in df.schema.items()
+        if dtype == pl.String
+        and df[col].n_unique() < df.height * CATEGORICAL_MAX_UNIQUE_RATIO
+        and df[col].cast(pl.Float64, strict=False).is_null().all()
+    ]
+    if not categorical_cols:
+        return df
+    return df.with_columns(pl.col(categorical_cols).cast(pl.Categorical))
+
+# Parsed workbooks are persisted here as one Parquet file per sheet, keyed by content digest,
+# so a restart or cache eviction does not require parsing the Excel file again.
+# Bump PARQUET_CACHE_VERSION whenever the loader's output changes (engine options,
+# categorical threshold, ...): entries written by older versions are then ignored and deleted.
+PARQUET_CACHE_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".parquet_cache")
+PARQUET_CACHE_VERSION = 2
+PARQUET_CACHE_DIR = os.path.join(PARQUET_CACHE_ROOT, f"v{PARQUET_CACHE_VERSION}")
+# Least recently used workbooks are evicted once the cache grows past this size
+PARQUET_CACHE_MAX_BYTES = 2 * 1024 ** 3
+# In-progress writes live in directories with this prefix and are skipped by reads and pruning.
+# A write left behind by a killed process is deleted once it is older than PARQUET_CACHE_STALE_SECONDS.
+_PARQUET_CACHE_TMP_PREFIX = ".writing-"
+PARQUET_CACHE_STALE_SECONDS = 60 * 60
+# Evicted entries are renamed to this prefix before deletion, so a reader never sees a half-deleted workbook
+_PARQUET_CACHE_DELETING_PREFIX = ".deleting-"
+
+def _dir_size(path):
+    """Total size in bytes of the files directly inside path."""
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def _delete_cache_entry(path):
+    """Atomically takes a cache entry out of use by renaming it, then deletes it."""
+    deleting_path = os.path.join(
+        os.path.dirname(path), f"{_PARQUET_CACHE_DELETING_PREFIX}{uuid.uuid4().hex}"
+    )
+    try:
+        os.rename(path, deleting_path)
+    except OSError:
+        # Already evicted by another session
+        return
+    shutil.rmtree(deleting_path, ignore_errors=True)
+
+def _prune_parquet_cache():
+    """
+    Deletes cache entries from older loader versions and leftovers of interrupted writes
+    or deletions, then evicts the least recently used workbooks until the cache fits in
+    PARQUET_CACHE_MAX_BYTES. The most recently used workbook is always kept.
+    """
+    for entry in os.scandir(PARQUET_CACHE_ROOT):
+        if entry.path != PARQUET_CACHE_DIR:
+            _delete_cache_entry(entry.path)
+
+    now = time.time()
+    entries = []
+    for entry in os.scandir(PARQUET_CACHE_DIR):
+        try:
+            if entry.name.startswith(_PARQUET_CACHE_DELETING_PREFIX):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.startswith(_PARQUET_CACHE_TMP_PREFIX):
+                if now - entry.stat().st_mtime > PARQUET_CACHE_STALE_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.is_dir():
+                entries.append((entry.stat().st_mtime, _dir_size(entry.path), entry.path))
+        except OSError:
+            # The entry was renamed or deleted by another session while scanning
+            continue
+
+    # Reads refresh the directory's mtime, so newest first means most recently used first
+    entries.sort(reverse=True)
+    total_bytes = 0
+    for position, (_, size, path) in enumerate(entries):
+        total_bytes += size
+        if position > 0 and total_bytes > PARQUET_CACHE_MAX_BYTES:
+            _delete_cache_entry(path)
+
+def _read_parquet_cache(content_digest):
+    """
+    Returns the cached sheets for content_digest, or None if the workbook has not been cached
+    or its entry could not be read (e.g. it was evicted mid-read); the caller then re-parses the file.
+    """
+    cache_path = os.path.join(PARQUET_CACHE_DIR, content_digest)
+    if not os.path.isdir(cache_path):
+        return None
+    try:
+        # Mark the entry as recently used for LRU eviction
+        os.utime(cache_path)
+        # Files are named "<position>__<sheet name>.parquet", so sorting restores the sheet order
+        polars_dfs = {}
+        for file_name in sorted(os.listdir(cache_path)):
+            sheet_name = file_name.split("__", 1)[1][:-len(".parquet")]
+            polars_dfs[sheet_name] = pl.read_parquet(os.path.join(cache_path, file_name), memory_map=True)
+        return polars_dfs
+    except (OSError, pl.exceptions.PolarsError):
+        return None
+
+def _write_parquet_cache(content_digest, polars_dfs):
+    """Writes every sheet to the Parquet cache. Failures only cost the cache, never the load."""
+    cache_path = os.path.join(PARQUET_CACHE_DIR, content_digest)
+    tmp_path = None
+    try:
+        os.makedirs(PARQUET_CACHE_DIR, exist_ok=True)
+        # Write into a temporary directory and rename it, so a partial cache is never read
+        tmp_path = tempfile.mkdtemp(prefix=_PARQUET_CACHE_TMP_PREFIX, dir=PARQUET_CACHE_DIR)
+        for position, (sheet_name, df) in enumerate(polars_dfs.items()):
+            df.write_parquet(
+                os.path.join(tmp_path, f"{position:04d}__{sheet_name}.parquet"),
+                compression='zstd',
+                statistics=True
+            )
+        os.rename(tmp_path, cache_path)
+        _prune_parquet_cache()
+    except OSError as e:
+        if tmp_path:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        # The rename also fails when another session cached the same workbook first
+        if not os.path.isdir(cache_path):
+            st.warning(f"Could not write the Parquet cache: {e}")
+
+# Modern .xlsx workbooks are read straight into Polars with the Rust-based calamine engine.
+# Legacy .xls files keep the pandas path (xlrd engine) as a fallback.
+# @st.cache_resource returns the cached DataFrames by reference instead of pickling them on every hit.
+# Callers must treat the returned frames as read-only (Polars operations return new frames).
+@st.cache_resource(show_spinner="Loading and caching Excel file...")
+def load_excel_data(_file_content, file_name, content_digest):
     """
     Loads all sheets from the content of an uploaded Excel file into a dictionary of Polars DataFrames.
     
     Args:
-        file_content (bytes): The byte content of the uploaded file.
+        _file_content (bytes): The byte content of the uploaded file. The leading underscore
+            tells Streamlit not to hash it; content_digest is used as the cache key instead.
         file_name (str): The name of the file, used for display and caching.
+        content_digest (str): Collision-resistant digest (BLAKE2b) of the file content, computed
+            once by the caller. It keys both the in-process and the on-disk cache, which are
+            shared by all sessions, so a fast non-cryptographic hash must not be used here.
 
     Returns:
         A dictionary where keys are sheet names and values are Polars DataFrames.
         Returns None if the file cannot be processed.
     """
-    if file_content is None:
+    if _file_content is None:
         return None
         
     try:
-        file_bytes = BytesIO(file_content)
-        
-        # Use pandas to read all sheets, as it has a more robust engine for this.
-        pd_sheets = pd.read_excel(file_bytes, sheet_name=None, engine='openpyxl')
-        
-        # Convert the dictionary of pandas DataFrames to Polars DataFrames
-        polars_dfs = {sheet_name: pl.from_pandas(df) for sheet_name, df in pd_sheets.items()}
+        polars_dfs = _read_parquet_cache(content_digest)
+        if polars_dfs is None:
+            if file_name.lower().endswith('.xls'):
+                # Legacy format: read with pandas/xlrd, then convert to Polars through Arrow
+                # so numeric columns are handed over without an extra copy
+                pd_sheets = pd.read_excel(BytesIO(_file_content), sheet_name=None, engine='xlrd')
+                polars_dfs = {
+                    sheet_name: pl.from_arrow(pa.Table.from_pandas(df, preserve_index=False, safe=False))
+                    for sheet_name, df in pd_sheets.items()
+                }
+            else:
+                # calamine parsing releases the GIL, so sheets are parsed concurrently.
+                # A fastexcel reader cannot be shared across threads (loading a sheet borrows it
+                # mutably), so each thread opens the workbook from its own buffer; the pool is
+                # capped to limit how many copies of the workbook index are held at once
+                sheet_names = fastexcel.read_excel(_file_content).sheet_names
+
+                def read_sheet(sheet_name):
+                    # Scan all rows when inferring the schema. Blank sheets load as empty frames
+                    # and blank rows are kept, so 1-based row numbers match the worksheet
+                    return pl.read_excel(
+                        BytesIO(_file_content),
+                        sheet_name=sheet_name,
+                        engine='calamine',
+                        infer_schema_length=None,
+                        drop_empty_rows=False,
+                        raise_if_empty=False
+                    )
+
+                max_workers = max(1, min(len(sheet_names), os.cpu_count() or 1))
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    polars_dfs = dict(zip(sheet_names, executor.map(read_sheet, sheet_names)))
         
+            polars_dfs = {sheet_name: _categorize_low_cardinality(df) for sheet_name, df in polars_dfs.items()}
+            _write_parquet_cache(content_digest, polars_dfs)
+
         st.success(f"Successfully loaded {len(polars_dfs)} sheets from `{file_name}`.")
         return polars_dfs
         
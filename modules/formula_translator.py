@@ -1,60 +1,113 @@
 import polars as pl
 import streamlit as st
 
-def apply_analysis(main_df, analysis_def, all_dfs):
+# Maps the UI aggregation names to the Polars expression methods that compute them
+AGG_METHODS = {
+    'Sum': 'sum',
+    'Average': 'mean',
+    'Min': 'min',
+    'Max': 'max',
+}
+
+# Operations that only add a column computed row-wise from existing ones.
+# Consecutive steps of these types can be evaluated together in one with_columns call.
+EXPRESSION_OPS = ('MATH', 'IF')
+
+def apply_analysis_lazy(main_lf, analysis_def, all_dfs):
     """
-    Applies a single analysis step to the main DataFrame.
+    Adds a single analysis step to the lazy query plan of the main sheet.
     Acts as a router to the specific analysis function.
+    Nothing is computed here; the caller collects the final LazyFrame once.
     """
     op_type = analysis_def.get('operation_type')
 
     # A new column is not always created now, but we need a name for the step
     if not analysis_def.get('new_col_name'):
         st.error("Please provide a name for the new column or analysis step.")
-        return main_df
+        return main_lf
 
-    try:
-        if op_type == 'VLOOKUP':
-            return apply_vlookup(main_df, analysis_def, all_dfs)
-        elif op_type == 'MATH':
-            return apply_math(main_df, analysis_def)
-        elif op_type == 'IF':
-            return apply_if_condition(main_df, analysis_def)
-        elif op_type == 'CONDITIONAL_AGG':
-            return apply_conditional_agg(main_df, analysis_def)
-        else:
-            st.warning(f"Operation '{op_type}' is not yet implemented.")
-            return main_df
-    except Exception as e:
-        st.error(f"An error occurred during the '{op_type}' operation: {e}")
-        return main_df
-
-def apply_vlookup(main_df, analysis_def, all_dfs):
+    # Errors propagate to the caller, which reports them against the failing step
+    if op_type == 'VLOOKUP':
+        return apply_vlookup(main_lf, analysis_def, all_dfs)
+    elif op_type == 'MATH':
+        return apply_math(main_lf, analysis_def)
+    elif op_type == 'IF':
+        return apply_if_condition(main_lf, analysis_def)
+    elif op_type == 'CONDITIONAL_AGG':
+        return apply_conditional_agg(main_lf, analysis_def)
+    else:
+        st.warning(f"Operation '{op_type}' is not yet implemented.")
+        return main_lf
+
+def build_expr(analysis_def, schema):
+    """
+    Builds the new-column expression for an expression-only step (see EXPRESSION_OPS).
+    Used to batch consecutive MATH/IF steps into a single with_columns call.
+    schema is the schema of the frame the expression will be evaluated on.
+    """
+    op_type = analysis_def.get('operation_type')
+
+    if op_type == 'MATH':
+        return build_math_expr(analysis_def, schema)
+    elif op_type == 'IF':
+        return build_if_expr(analysis_def)
+    else:
+        raise ValueError(f"Operation '{op_type}' cannot be expressed as a single column expression.")
+
+def apply_vlookup(main_lf, analysis_def, all_dfs):
     """Performs a left join, similar to VLOOKUP."""
     lookup_df = all_dfs[analysis_def['lookup_df_name']]
     new_col_name = analysis_def['new_col_name']
 
-    lookup_subset = lookup_df.select([
-        analysis_def['right_on'],
-        analysis_def['value_col']
-    ])
+    # The projected lookup columns are materialized once per session as a single contiguous
+    # chunk (fast hash-table build) and reused by every pipeline run that needs them
+    cache_key = (analysis_def['lookup_df_name'], analysis_def['right_on'], analysis_def['value_col'])
+    lookup_subset = st.session_state.lookup_cache.get(cache_key)
+    if lookup_subset is None:
+        lookup_subset = lookup_df.select([
+            analysis_def['right_on'],
+            analysis_def['value_col']
+        ]).rechunk()
+        st.session_state.lookup_cache[cache_key] = lookup_subset
+    lookup_subset = lookup_subset.lazy()
+
+    # Text keys may be Categorical on one sheet and String on the other; match the main sheet's key
+    left_dtype = main_lf.collect_schema()[analysis_def['left_on']]
+    right_dtype = lookup_df.schema[analysis_def['right_on']]
+    text_dtypes = (pl.Categorical, pl.String)
+    if left_dtype != right_dtype and left_dtype in text_dtypes and right_dtype in text_dtypes:
+        lookup_subset = lookup_subset.with_columns(pl.col(analysis_def['right_on']).cast(left_dtype))
 
-    result_df = main_df.join(
+    result_lf = main_lf.join(
         lookup_subset,
         left_on=analysis_def['left_on'],
         right_on=analysis_def['right_on'],
         how='left'
     )
 
-    return result_df.rename({analysis_def['value_col']: new_col_name})
+    return result_lf.rename({analysis_def['value_col']: new_col_name})
 
-def apply_math(main_df, analysis_def):
+def apply_math(main_lf, analysis_def):
     """Performs a basic arithmetic operation between two columns."""
+    return main_lf.with_columns(build_math_expr(analysis_def, main_lf.collect_schema()))
+
+def _as_float(col_name, schema):
+    """
+    Casts a column to Float64, turning non-numeric values into nulls.
+    Categorical columns have no numeric cast, so they are read as text first.
+    """
+    col = pl.col(col_name)
+    if schema.get(col_name) == pl.Categorical:
+        col = col.cast(pl.String)
+    return col.cast(pl.Float64, strict=False)
+
+def build_math_expr(analysis_def, schema):
+    """Builds the expression for a basic arithmetic operation between two columns."""
     new_col_name = analysis_def['new_col_name']
     op = analysis_def['operator']
 
-    col1 = pl.col(analysis_def['first_col']).cast(pl.Float64, strict=False)
-    col2 = pl.col(analysis_def['second_col']).cast(pl.Float64, strict=False)
+    col1 = _as_float(analysis_def['first_col'], schema)
+    col2 = _as_float(analysis_def['second_col'], schema)
 
     if op == '+': expression = col1 + col2
     elif op == '-': expression = col1 - col2
@@ -62,7 +115,7 @@ def apply_math(main_df, analysis_def):
     elif op == '/': expression = col1 / col2
     else: raise ValueError(f"Unsupported operator: {op}")
 
-    return main_df.with_columns(expression.alias(new_col_name))
+    return expression.alias(new_col_name)
 
 def _attempt_cast(value_str):
     """Helper to cast string input to numeric if possible."""
@@ -71,87 +124,117 @@ def _attempt_cast(value_str):
     except (ValueError, TypeError):
         return value_str
 
-def apply_if_condition(main_df, analysis_def):
-    """Applies a conditional (IF) expression."""
-    new_col_name = analysis_def['new_col_name']
-    if_col = pl.col(analysis_def['if_col'])
-    op = analysis_def['if_operator']
-    compare_type = analysis_def.get('if_compare_type', 'Absolute Value')
+# Maps the UI comparison operators to the Polars expression methods that apply them
+COMPARISON_METHODS = {
+    '==': pl.Expr.eq,
+    '!=': pl.Expr.ne,
+    '>': pl.Expr.gt,
+    '<': pl.Expr.lt,
+    '>=': pl.Expr.ge,
+    '<=': pl.Expr.le,
+}
 
+def _compile_condition(analysis_def, col_key, op_key, compare_type_key, value_key, compare_col_key):
+    """
+    Builds the comparison expression for a step from its condition parameters.
+    The compiled expression is memoized on analysis_def['_compiled'] and reused
+    as long as the parameters it was built from are unchanged.
+    """
+    op = analysis_def[op_key]
+    compare_type = analysis_def.get(compare_type_key, 'Absolute Value')
     # Handle comparison to either a value or another column
     if compare_type == 'Absolute Value':
-        compare_val = _attempt_cast(analysis_def['if_value'])
+        compare_repr = ('value', analysis_def[value_key])
     else: # Compare to another column
-        compare_val = pl.col(analysis_def['if_compare_col'])
+        compare_repr = ('column', analysis_def[compare_col_key])
+    cache_key = (op, analysis_def[col_key], compare_repr)
+
+    cached = analysis_def.get('_compiled')
+    if cached is not None and cached[0] == cache_key:
+        return cached[1]
+
+    if op not in COMPARISON_METHODS:
+        raise ValueError(f"Unsupported operator: {op}")
+    if compare_repr[0] == 'value':
+        compare_val = _attempt_cast(compare_repr[1])
+    else:
+        compare_val = pl.col(compare_repr[1])
+    condition = COMPARISON_METHODS[op](pl.col(analysis_def[col_key]), compare_val)
+
+    analysis_def['_compiled'] = (cache_key, condition)
+    return condition
+
+def apply_if_condition(main_lf, analysis_def):
+    """Applies a conditional (IF) expression."""
+    return main_lf.with_columns(build_if_expr(analysis_def))
+
+def build_if_expr(analysis_def):
+    """Builds the conditional (IF) expression."""
+    new_col_name = analysis_def['new_col_name']
+    condition = _compile_condition(
+        analysis_def, 'if_col', 'if_operator', 'if_compare_type', 'if_value', 'if_compare_col'
+    )
 
     true_val = _attempt_cast(analysis_def['value_if_true'])
     false_val = _attempt_cast(analysis_def['value_if_false'])
 
-    if op == '==': condition = (if_col == compare_val)
-    elif op == '!=': condition = (if_col != compare_val)
-    elif op == '>': condition = (if_col > compare_val)
-    elif op == '<': condition = (if_col < compare_val)
-    elif op == '>=': condition = (if_col >= compare_val)
-    elif op == '<=': condition = (if_col <= compare_val)
-    else: raise ValueError(f"Unsupported operator: {op}")
+    # Type both branches together so the new column is Float64 only when both are numeric,
+    # and a consistent String column otherwise
+    if isinstance(true_val, float) and isinstance(false_val, float):
+        result_dtype = pl.Float64
+    else:
+        result_dtype = pl.String
+        true_val = analysis_def['value_if_true']
+        false_val = analysis_def['value_if_false']
 
-    expression = pl.when(condition).then(pl.lit(true_val)).otherwise(pl.lit(false_val))
+    expression = (
+        pl.when(condition)
+        .then(pl.lit(true_val, dtype=result_dtype))
+        .otherwise(pl.lit(false_val, dtype=result_dtype))
+    )
 
-    return main_df.with_columns(expression.alias(new_col_name))
+    return expression.alias(new_col_name)
 
 
-def apply_conditional_agg(main_df, analysis_def):
+def apply_conditional_agg(main_lf, analysis_def):
     """
-    Performs a conditional aggregation (SUMIF, COUNTIF, etc.) on the main DataFrame.
+    Performs a conditional aggregation (SUMIF, COUNTIF, etc.) on the main sheet.
+    The aggregate is expressed as a Polars expression so it stays part of the lazy plan.
     The result can be broadcast to a new column or placed in a specific cell/range.
     """
     new_col_name = analysis_def['new_col_name']
-    if_col = pl.col(analysis_def['cond_agg_if_col'])
-    op = analysis_def['cond_agg_operator']
-    compare_type = analysis_def.get('cond_agg_compare_type', 'Absolute Value')
     agg_func = analysis_def['cond_agg_function']
     calc_col_name = analysis_def.get('cond_agg_calc_col')
 
     # Step 1: Build the filter condition (handles value or column comparison)
-    if compare_type == 'Absolute Value':
-        compare_val = _attempt_cast(analysis_def['cond_agg_value'])
-    else: # Compare to another column
-        compare_val = pl.col(analysis_def['cond_agg_compare_col'])
-    
-    if op == '==': condition = (if_col == compare_val)
-    elif op == '!=': condition = (if_col != compare_val)
-    elif op == '>': condition = (if_col > compare_val)
-    elif op == '<': condition = (if_col < compare_val)
-    elif op == '>=': condition = (if_col >= compare_val)
-    elif op == '<=': condition = (if_col <= compare_val)
-    else: raise ValueError(f"Unsupported operator: {op}")
+    condition = _compile_condition(
+        analysis_def, 'cond_agg_if_col', 'cond_agg_operator',
+        'cond_agg_compare_type', 'cond_agg_value', 'cond_agg_compare_col'
+    )
+
+    # Step 2: Build the aggregation over the matching rows
+    if agg_func == 'Count':
+        agg_expr = condition.sum()
+    elif calc_col_name:
+        if agg_func not in AGG_METHODS:
+            raise ValueError(f"Unsupported aggregation: {agg_func}")
+        # Filtering inside the expression aggregates in one pass without a filtered copy of the frame
+        agg_expr = getattr(pl.col(calc_col_name).filter(condition), AGG_METHODS[agg_func])()
+    else:
+        st.error(f"For '{agg_func}', you must select a column to calculate on.")
+        return main_lf
+
+    # No matching rows yields 0, as in Excel
+    result_value = pl.when(condition.any()).then(agg_expr).otherwise(pl.lit(0))
 
-    # Step 2: Filter the DataFrame
-    filtered_df = main_df.filter(condition)
-
-    # Step 3: Perform the aggregation
-    result_value = 0
-    if filtered_df.height > 0:
-        if agg_func == 'Count':
-            result_value = filtered_df.height
-        elif calc_col_name:
-            calc_col = pl.col(calc_col_name)
-            if agg_func == 'Sum': result_value = filtered_df.select(calc_col.sum()).item()
-            elif agg_func == 'Average': result_value = filtered_df.select(calc_col.mean()).item()
-            elif agg_func == 'Min': result_value = filtered_df.select(calc_col.min()).item()
-            elif agg_func == 'Max': result_value = filtered_df.select(calc_col.max()).item()
-        else:
-            st.error(f"For '{agg_func}', you must select a column to calculate on.")
-            return main_df
-
-    # Step 4: Handle the output location
+    # Step 3: Handle the output location
     start_row = analysis_def.get('output_start_row')
     end_row = analysis_def.get('output_end_row')
     target_col = analysis_def.get('output_target_col')
 
     # If no specific location is given, use the default broadcast behavior
     if not start_row:
-        return main_df.with_columns(pl.lit(result_value).alias(new_col_name))
+        return main_lf.with_columns(result_value.alias(new_col_name))
 
     # --- Logic for targeted output ---
     # Adjust for 0-based indexing
@@ -159,25 +242,31 @@ def apply_conditional_agg(main_df, analysis_def):
     # If no end row, it's a single cell
     end_idx = (end_row - 1) if end_row else start_idx
 
-    if start_idx >= main_df.height:
-        st.error(f"Error: Start row {start_row} is beyond the end of the table ({main_df.height} rows).")
-        return main_df
-
     # Determine the column to place the result in
     output_col_name = target_col if target_col else new_col_name
-    
-    # Create a boolean mask for the rows to be updated
-    row_indices = pl.arange(0, main_df.height)
-    mask = (row_indices >= start_idx) & (row_indices <= end_idx)
-
-    # If the target column doesn't exist, create it with nulls
-    if output_col_name not in main_df.columns:
-        main_df = main_df.with_columns(pl.lit(None).alias(output_col_name))
-
-    # Use pl.when/then/otherwise to update the specific range
-    return main_df.with_columns(
-        pl.when(mask)
-        .then(pl.lit(result_value))
-        .otherwise(pl.col(output_col_name))
+
+    # Number of rows to overwrite, clamped to the end of the table inside the plan
+    # (earlier joins can change the row count, so it is not known until collect).
+    # A start row past the end of the table writes nothing.
+    last_idx = pl.len().cast(pl.Int64) - 1
+    block_len = (pl.min_horizontal(pl.lit(end_idx), last_idx) - start_idx + 1).clip(lower_bound=0)
+
+    # If the target column doesn't exist, create it with nulls of the result's dtype
+    # (resolved from the plan's schema, nothing is computed)
+    schema = main_lf.collect_schema()
+    if output_col_name not in schema.names():
+        result_dtype = main_lf.select(result_value.alias(output_col_name)).collect_schema()[output_col_name]
+        main_lf = main_lf.with_columns(pl.lit(None, dtype=result_dtype).alias(output_col_name))
+
+    # Rebuild the column from three slices so only the target range is written,
+    # instead of evaluating a row mask over the whole table.
+    # A Categorical target has no common type with a number, so it is written back as text.
+    output_col = pl.col(output_col_name)
+    if schema.get(output_col_name) == pl.Categorical:
+        output_col = output_col.cast(pl.String)
+    return main_lf.with_columns(
+        output_col.head(start_idx)
+        .append(pl.repeat(result_value, block_len))
+        .append(output_col.slice(pl.lit(start_idx) + block_len))
         .alias(output_col_name)
     )
@@ -8,7 +8,22 @@ OPERATION_OPTIONS = {
     "MATH": "Calculate from other columns (Math)",
 }
 
-def render_vlookup_builder(analysis_def, all_dfs, main_df_columns, key_prefix):
+# Fixed option lists and their value -> position lookups, built once at import time
+MATH_OPERATORS = ['+', '-', '*', '/']
+COMPARISON_OPERATORS = ['==', '!=', '>', '<', '>=', '<=']
+COMPARE_TYPES = ["Absolute Value", "Another Column"]
+AGG_FUNCTIONS = ['Sum', 'Count', 'Average', 'Min', 'Max']
+
+def build_index(options):
+    """Maps each option to its position so selectbox indices are O(1) dict lookups."""
+    return {option: idx for idx, option in enumerate(options)}
+
+MATH_OPERATOR_INDEX = build_index(MATH_OPERATORS)
+COMPARISON_OPERATOR_INDEX = build_index(COMPARISON_OPERATORS)
+COMPARE_TYPE_INDEX = build_index(COMPARE_TYPES)
+AGG_FUNCTION_INDEX = build_index(AGG_FUNCTIONS)
+
+def render_vlookup_builder(analysis_def, all_dfs, main_df_columns, col_index, key_prefix):
     """Renders UI for VLOOKUP operation."""
     st.subheader("VLOOKUP Configuration")
     st.info("This operation joins data from another sheet based on a matching key, similar to Excel's VLOOKUP.")
@@ -18,37 +33,39 @@ def render_vlookup_builder(analysis_def, all_dfs, main_df_columns, key_prefix):
         analysis_def['left_on'] = st.selectbox(
             "Left Column (from this sheet)",
             options=main_df_columns,
-            index=main_df_columns.index(analysis_def.get('left_on')) if analysis_def.get('left_on') in main_df_columns else 0,
+            index=col_index.get(analysis_def.get('left_on'), 0),
             key=f"{key_prefix}_vlookup_left_on"
         )
 
     with col2:
         df_names = list(all_dfs.keys())
+        df_name_index = build_index(df_names)
         selected_df_name = st.selectbox(
             "Lookup Table (Sheet to get data from)",
             options=df_names,
-            index=df_names.index(analysis_def.get('lookup_df_name')) if analysis_def.get('lookup_df_name') in df_names else 0,
+            index=df_name_index.get(analysis_def.get('lookup_df_name'), 0),
             key=f"{key_prefix}_vlookup_df"
         )
         analysis_def['lookup_df_name'] = selected_df_name
         lookup_df_cols = all_dfs[selected_df_name].columns
+        lookup_col_index = build_index(lookup_df_cols)
 
     with col3:
         analysis_def['right_on'] = st.selectbox(
             "Right Column (from lookup table)",
             options=lookup_df_cols,
-            index=lookup_df_cols.index(analysis_def.get('right_on')) if analysis_def.get('right_on') in lookup_df_cols else 0,
+            index=lookup_col_index.get(analysis_def.get('right_on'), 0),
             key=f"{key_prefix}_vlookup_right_on"
         )
 
     analysis_def['value_col'] = st.selectbox(
         "Column to Return (from lookup table)",
         options=lookup_df_cols,
-        index=lookup_df_cols.index(analysis_def.get('value_col')) if analysis_def.get('value_col') in lookup_df_cols else 0,
+        index=lookup_col_index.get(analysis_def.get('value_col'), 0),
         key=f"{key_prefix}_vlookup_value_col"
     )
 
-def render_math_builder(analysis_def, main_df_columns, key_prefix):
+def render_math_builder(analysis_def, main_df_columns, col_index, key_prefix):
     """Renders UI for Math operation."""
     st.subheader("Math Calculation")
     col1, col2, col3 = st.columns(3)
@@ -57,25 +74,25 @@ def render_math_builder(analysis_def, main_df_columns, key_prefix):
         analysis_def['first_col'] = st.selectbox(
             "First Column",
             options=main_df_columns,
-            index=main_df_columns.index(analysis_def.get('first_col')) if analysis_def.get('first_col') in main_df_columns else 0,
+            index=col_index.get(analysis_def.get('first_col'), 0),
             key=f"{key_prefix}_math_first_col"
         )
     with col2:
         analysis_def['operator'] = st.selectbox(
             "Operator",
-            options=['+', '-', '*', '/'],
-            index=['+', '-', '*', '/'].index(analysis_def.get('operator')) if analysis_def.get('operator') in ['+', '-', '*', '/'] else 0,
+            options=MATH_OPERATORS,
+            index=MATH_OPERATOR_INDEX.get(analysis_def.get('operator'), 0),
             key=f"{key_prefix}_math_op"
         )
     with col3:
         analysis_def['second_col'] = st.selectbox(
             "Second Column",
             options=main_df_columns,
-            index=main_df_columns.index(analysis_def.get('second_col')) if analysis_def.get('second_col') in main_df_columns else 0,
+            index=col_index.get(analysis_def.get('second_col'), 0),
             key=f"{key_prefix}_math_second_col"
         )
 
-def render_if_builder(analysis_def, main_df_columns, key_prefix):
+def render_if_builder(analysis_def, main_df_columns, col_index, key_prefix):
     """Renders UI for IF Condition operation."""
     st.subheader("IF Condition (Categorization)")
     st.info("This creates a new column with one of two values, based on a condition.")
@@ -85,25 +102,24 @@ def render_if_builder(analysis_def, main_df_columns, key_prefix):
         analysis_def['if_col'] = st.selectbox(
             "Column to Check",
             options=main_df_columns,
-            index=main_df_columns.index(analysis_def.get('if_col')) if analysis_def.get('if_col') in main_df_columns else 0,
+            index=col_index.get(analysis_def.get('if_col'), 0),
             key=f"{key_prefix}_if_col"
         )
     with col2:
-        operators = ['==', '!=', '>', '<', '>=', '<=']
         analysis_def['if_operator'] = st.selectbox(
             "Operator",
-            options=operators,
-            index=operators.index(analysis_def.get('if_operator')) if analysis_def.get('if_operator') in operators else 0,
+            options=COMPARISON_OPERATORS,
+            index=COMPARISON_OPERATOR_INDEX.get(analysis_def.get('if_operator'), 0),
             key=f"{key_prefix}_if_op"
         )
     with col3:
         # UI to choose between comparing to a value or another column
         compare_type = st.radio(
             "Compare Against",
-            ["Absolute Value", "Another Column"],
+            COMPARE_TYPES,
             key=f"{key_prefix}_if_compare_type",
             horizontal=True,
-            index=["Absolute Value", "Another Column"].index(analysis_def.get('if_compare_type', 'Absolute Value'))
+            index=COMPARE_TYPE_INDEX.get(analysis_def.get('if_compare_type'), 0)
         )
         analysis_def['if_compare_type'] = compare_type
 
@@ -115,10 +131,11 @@ def render_if_builder(analysis_def, main_df_columns, key_prefix):
             )
         else:
             other_cols = [c for c in main_df_columns if c != analysis_def.get('if_col')]
+            other_col_index = build_index(other_cols)
             analysis_def['if_compare_col'] = st.selectbox(
                 "Column to Compare Against",
                 options=other_cols,
-                index=other_cols.index(analysis_def.get('if_compare_col')) if analysis_def.get('if_compare_col') in other_cols else 0,
+                index=other_col_index.get(analysis_def.get('if_compare_col'), 0),
                 key=f"{key_prefix}_if_compare_col_select"
             )
 
@@ -137,7 +154,7 @@ def render_if_builder(analysis_def, main_df_columns, key_prefix):
             key=f"{key_prefix}_if_false"
         )
 
-def render_conditional_agg_builder(analysis_def, main_df_columns, key_prefix):
+def render_conditional_agg_builder(analysis_def, main_df_columns, col_index, key_prefix):
     """Renders UI for a powerful conditional aggregation (SUMIF, COUNTIF, etc.)."""
     st.subheader("Conditional Aggregation")
     st.info("This calculates a result (like a sum or count) on a column, but only for rows that meet specific criteria.")
@@ -149,24 +166,23 @@ def render_conditional_agg_builder(analysis_def, main_df_columns, key_prefix):
         analysis_def['cond_agg_if_col'] = st.selectbox(
             "Column to Check",
             options=main_df_columns,
-            index=main_df_columns.index(analysis_def.get('cond_agg_if_col')) if analysis_def.get('cond_agg_if_col') in main_df_columns else 0,
+            index=col_index.get(analysis_def.get('cond_agg_if_col'), 0),
             key=f"{key_prefix}_cond_agg_if_col"
         )
     with col2:
-        operators = ['==', '!=', '>', '<', '>=', '<=']
         analysis_def['cond_agg_operator'] = st.selectbox(
             "Operator",
-            options=operators,
-            index=operators.index(analysis_def.get('cond_agg_operator')) if analysis_def.get('cond_agg_operator') in operators else 0,
+            options=COMPARISON_OPERATORS,
+            index=COMPARISON_OPERATOR_INDEX.get(analysis_def.get('cond_agg_operator'), 0),
             key=f"{key_prefix}_cond_agg_op"
         )
     with col3:
         compare_type = st.radio(
             "Compare Against",
-            ["Absolute Value", "Another Column"],
+            COMPARE_TYPES,
             key=f"{key_prefix}_cond_agg_compare_type",
             horizontal=True,
-            index=["Absolute Value", "Another Column"].index(analysis_def.get('cond_agg_compare_type', 'Absolute Value'))
+            index=COMPARE_TYPE_INDEX.get(analysis_def.get('cond_agg_compare_type'), 0)
         )
         analysis_def['cond_agg_compare_type'] = compare_type
 
@@ -178,10 +194,11 @@ def render_conditional_agg_builder(analysis_def, main_df_columns, key_prefix):
             )
         else:
             other_cols = [c for c in main_df_columns if c != analysis_def.get('cond_agg_if_col')]
+            other_col_index = build_index(other_cols)
             analysis_def['cond_agg_compare_col'] = st.selectbox(
                 "Column to Compare Against",
                 options=other_cols,
-                index=other_cols.index(analysis_def.get('cond_agg_compare_col')) if analysis_def.get('cond_agg_compare_col') in other_cols else 0,
+                index=other_col_index.get(analysis_def.get('cond_agg_compare_col'), 0),
                 key=f"{key_prefix}_cond_agg_compare_col_select"
             )
 
@@ -190,11 +207,10 @@ def render_conditional_agg_builder(analysis_def, main_df_columns, key_prefix):
     st.write("##### **Calculation (On the Rows That Match)**")
     col4, col5 = st.columns(2)
     with col4:
-        agg_functions = ['Sum', 'Count', 'Average', 'Min', 'Max']
         analysis_def['cond_agg_function'] = st.selectbox(
             "Calculation to Perform",
-            options=agg_functions,
-            index=agg_functions.index(analysis_def.get('cond_agg_function')) if analysis_def.get('cond_agg_function') in agg_functions else 0,
+            options=AGG_FUNCTIONS,
+            index=AGG_FUNCTION_INDEX.get(analysis_def.get('cond_agg_function'), 0),
             key=f"{key_prefix}_cond_agg_func"
         )
 
@@ -203,7 +219,7 @@ def render_conditional_agg_builder(analysis_def, main_df_columns, key_prefix):
             analysis_def['cond_agg_calc_col'] = st.selectbox(
                 f"Column to {analysis_def.get('cond_agg_function', 'Sum')}",
                 options=main_df_columns,
-                index=main_df_columns.index(analysis_def.get('cond_agg_calc_col')) if analysis_def.get('cond_agg_calc_col') in main_df_columns else 0,
+                index=col_index.get(analysis_def.get('cond_agg_calc_col'), 0),
                 key=f"{key_prefix}_cond_agg_calc_col"
             )
         else:
@@ -248,13 +264,14 @@ def render_operation_ui(analysis_def, all_dfs, main_df_columns, key_prefix):
     It modifies the analysis_def dictionary in place.
     """
     op_type = analysis_def.get('operation_type')
+    col_index = build_index(main_df_columns)
 
     if op_type == 'VLOOKUP':
-        render_vlookup_builder(analysis_def, all_dfs, main_df_columns, key_prefix)
+        render_vlookup_builder(analysis_def, all_dfs, main_df_columns, col_index, key_prefix)
     elif op_type == 'MATH':
-        render_math_builder(analysis_def, main_df_columns, key_prefix)
+        render_math_builder(analysis_def, main_df_columns, col_index, key_prefix)
     elif op_type == 'IF':
-        render_if_builder(analysis_def, main_df_columns, key_prefix)
+        render_if_builder(analysis_def, main_df_columns, col_index, key_prefix)
     elif op_type == 'CONDITIONAL_AGG':
-        render_conditional_agg_builder(analysis_def, main_df_columns, key_prefix)
+        render_conditional_agg_builder(analysis_def, main_df_columns, col_index, key_prefix)
 